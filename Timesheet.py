@@ -3,14 +3,54 @@ from datetime import datetime
 import numpy as np
 import re
 
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
 # Import Google Sheets libraries
 import gspread
 from google.oauth2.service_account import Credentials
 
-def process_time_tracking(csv_file):
+NS_PER_MINUTE = 60_000_000_000
+MINUTES_PER_DAY = 1440
+
+# Timestamp ending in a UTC offset, e.g. '2025-02-17T23:30:00+08:00'
+_UTC_OFFSET = re.compile(r'\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?\s*(?:Z|[+-]\d{2}:?\d{2})\s*$')
+
+# Week number embedded in export file names, e.g. 'export_week8_2025_detailed.csv'
+_WEEK_NUMBER = re.compile(r'week(\d+)', re.IGNORECASE)
+
+def format_minute_of_day(minutes):
+    """
+    Formats a minute-of-day integer as 'HH:MM'.
+    """
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def wall_clock_ns(dates):
+    """
+    Returns the local wall-clock times of a datetime Series as int64 nanoseconds,
+    dropping any timezone so offsets like +08:00 do not shift them to UTC.
+    """
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    return dates.to_numpy(dtype='datetime64[ns]').view('i8')
+
+def process_time_tracking(csv_file, verbose=False):
     try:
+        # Sniff the header and first row so the date columns can be parsed while reading
+        sample = pd.read_csv(csv_file, delimiter=',', nrows=1, dtype=str)
+        date_cols = [col for col in sample.columns if col.strip().lower() in ('start date', 'end date')]
+        # pyarrow converts offset timestamps to UTC, losing the wall-clock time sleep metrics use
+        has_offset = any(_UTC_OFFSET.search(value) for value in sample[date_cols].stack().dropna())
+
         # Read the CSV file
-        df = pd.read_csv(csv_file, delimiter=',')  # Ensure correct delimiter
+        if HAS_PYARROW and not has_offset:
+            df = pd.read_csv(csv_file, delimiter=',', engine='pyarrow', parse_dates=date_cols)
+        else:
+            df = pd.read_csv(csv_file, delimiter=',', engine='c', low_memory=False,
+                             cache_dates=True, parse_dates=date_cols, date_format='ISO8601')
     except FileNotFoundError:
         print(f"Error: Could not find the file '{csv_file}'")
         print("Please ensure the file exists in the current directory and the path is correct.")
@@ -19,27 +59,37 @@ def process_time_tracking(csv_file):
     # Standardize column names (strip spaces, lowercase)
     df.columns = df.columns.str.strip().str.lower()
     
-    # Convert start date and end date to datetime format
-    df['start date'] = pd.to_datetime(df['start date'], errors='coerce')
-    df['end date'] = pd.to_datetime(df['end date'], errors='coerce')
+    # Normalise activity names once so later filters compare category codes
+    df['timeline'] = df['timeline'].str.strip().str.lower().astype('category')
+    
+    # Dates are parsed on read; only fall back when a column held unparseable values
+    for col in ('start date', 'end date'):
+        if not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col], errors='coerce')
     
     # Drop rows where dates could not be converted
     df = df.dropna(subset=['start date', 'end date'])
     
-    # Calculate duration in minutes (remove decimals)
-    df['calculated duration'] = ((df['end date'] - df['start date']).dt.total_seconds() / 60).astype(int)
+    # Calculate duration in minutes (remove decimals) on the raw int64 nanoseconds
+    start_i8 = wall_clock_ns(df['start date'])
+    end_i8 = wall_clock_ns(df['end date'])
+    duration_ns = end_i8 - start_i8
+    # Truncate toward zero like an int cast, so a slightly negative entry counts as 0
+    df['calculated duration'] = np.sign(duration_ns) * (np.abs(duration_ns) // NS_PER_MINUTE)
     # Also calculate duration in hours (as a float)
-    df['duration_hours'] = df['calculated duration'] / 60
+    df['duration_hours'] = df['calculated duration'] * (1.0 / 60.0)
     
-    # Display processed data
-    print("Processed Time Tracking Data:")
-    print(df[['timeline', 'start date', 'end date', 'calculated duration', 'duration_hours']])
+    # Display processed data (formatting the full frame is costly, so it is opt-in)
+    if verbose:
+        print("Processed Time Tracking Data:")
+        print(df[['timeline', 'start date', 'end date', 'calculated duration', 'duration_hours']])
     
     # Summary: Total time spent per activity (in minutes and hours)
-    summary = df.groupby('timeline')['calculated duration'].sum().reset_index()
+    summary = df.groupby('timeline', observed=True, sort=False, as_index=False)['calculated duration'].sum()
     summary['duration_hours'] = summary['calculated duration'] / 60
-    print("\nTotal Time Spent Per Activity:")
-    print(summary)
+    if verbose:
+        print("\nTotal Time Spent Per Activity:")
+        print(summary)
     
     # Calculate tracking coverage for the week
     # Assume a full week is 7 days: 7 * 24 * 60 = 10080 minutes or 168 hours.
@@ -52,7 +102,8 @@ def process_time_tracking(csv_file):
     print(f"\nTracking Coverage: {tracking_percentage:.2f}% of time tracked (week total)")
     
     # Sleep tracking metrics
-    sleep_df = df[df['timeline'].str.lower() == 'sleep'].copy()
+    is_sleep = (df['timeline'] == 'sleep').to_numpy()
+    sleep_df = df[is_sleep].copy()
     
     on_bed_time_variance = None
     avg_sleep_duration = None
@@ -60,26 +111,26 @@ def process_time_tracking(csv_file):
     avg_wake_time = None
     
     if not sleep_df.empty:
-        sleep_df['date'] = sleep_df['start date'].dt.date
-        sleep_df['bedtime'] = sleep_df['start date'].dt.strftime('%H:%M:%S')
-        sleep_df['wake_time'] = sleep_df['end date'].dt.strftime('%H:%M:%S')
         sleep_df['sleep_duration'] = sleep_df['calculated duration']
         
-        bedtime_minutes = sleep_df['start date'].dt.hour * 60 + sleep_df['start date'].dt.minute
-        wake_time_minutes = sleep_df['end date'].dt.hour * 60 + sleep_df['end date'].dt.minute
+        # Minute-of-day from the wall-clock int64 arrays computed above, so a
+        # +08:00 bedtime of 23:30 stays 23:30 rather than its UTC 15:30
+        bedtime_minutes = (start_i8[is_sleep] // NS_PER_MINUTE) % MINUTES_PER_DAY
+        wake_time_minutes = (end_i8[is_sleep] // NS_PER_MINUTE) % MINUTES_PER_DAY
         
-        on_bed_time_variance = int(round(np.std(bedtime_minutes)))
-        avg_sleep_duration = int(round(sleep_df['sleep_duration'].mean() / 60))
+        # Stack duration, bedtime and wake time so their means reduce in one pass
+        sleep_stats = np.column_stack([
+            sleep_df['sleep_duration'].to_numpy(dtype=np.float64),
+            bedtime_minutes.astype(np.float64),
+            wake_time_minutes.astype(np.float64),
+        ])
+        mean_duration, mean_bedtime, mean_wake = sleep_stats.mean(axis=0)
         
-        avg_bed_minutes = int(round(bedtime_minutes.mean()))
-        avg_bed_hour = avg_bed_minutes // 60
-        avg_bed_min = avg_bed_minutes % 60
-        avg_bedtime = f"{avg_bed_hour:02d}:{avg_bed_min:02d}"
+        on_bed_time_variance = int(round(sleep_stats[:, 1].std()))
+        avg_sleep_duration = int(round(mean_duration / 60))
         
-        avg_wake_minutes = int(round(wake_time_minutes.mean()))
-        avg_wake_hour = avg_wake_minutes // 60
-        avg_wake_min = avg_wake_minutes % 60
-        avg_wake_time = f"{avg_wake_hour:02d}:{avg_wake_min:02d}"
+        avg_bedtime = format_minute_of_day(int(round(mean_bedtime)))
+        avg_wake_time = format_minute_of_day(int(round(mean_wake)))
         
         print("\nSleep Tracking Metrics:")
         print(f"On-Bed Time Variance: {on_bed_time_variance} min")
@@ -89,20 +140,18 @@ def process_time_tracking(csv_file):
     else:
         print("\nNo sleep data found.")
     
-    week_match = re.search(r'week(\d+)', csv_file, re.IGNORECASE)
+    week_match = _WEEK_NUMBER.search(csv_file)
     if week_match:
         week_number = int(week_match.group(1))
     else:
         week_number = df['start date'].min().isocalendar()[1]
     
     dynamic_categories = ['read', 'learn', 'work']
-    dynamic_data = {}
-    for cat in dynamic_categories:
-        match_row = summary[summary['timeline'].str.lower() == cat]
-        if not match_row.empty:
-            dynamic_data[cat] = round(match_row['calculated duration'].iloc[0] / 60, 2)
-        else:
-            dynamic_data[cat] = "Data Missing"
+    hours_by_cat = dict(zip(summary['timeline'].astype(str), summary['duration_hours']))
+    dynamic_data = {
+        cat: round(hours_by_cat[cat], 2) if cat in hours_by_cat else "Data Missing"
+        for cat in dynamic_categories
+    }
     
     year = df['start date'].min().year
     
@@ -130,28 +179,29 @@ def create_weekly_summary_txt(metrics, summary):
     The file is named 'week{week_number}_summary.txt'.
     """
     filename = f"week{metrics['week_number']}_summary.txt"
+    parts = [
+        f"Week {metrics['week_number']} Summary for Year {metrics['year']}\n",
+        "=" * 40 + "\n",
+        f"Total Time Tracked: {metrics['total_tracked_hours']:.2f} hours out of 168 hours possible\n",
+        f"Tracking Coverage: {metrics['tracking_percentage']:.2f}%\n\n",
+        "Sleep Tracking Metrics:\n",
+        f"  On-Bed Time Variance: {metrics['on_bed_time_variance']} min\n",
+        f"  Average Sleep Duration: {metrics['avg_sleep_duration']} h\n",
+        f"  Average Bedtime: {metrics['avg_bedtime']}\n",
+        f"  Average Wake-up Time: {metrics['avg_wake_time']}\n\n",
+        "Activity Summary (in hours):\n",
+    ]
+    # Sort the summary by duration_hours in descending order and round to one decimal
+    sorted_summary = summary.sort_values(by='duration_hours', ascending=False).reset_index(drop=True)
+    parts.extend(
+        f"  {activity.capitalize()}: {hours:.1f} hours\n"
+        for activity, hours in zip(sorted_summary['timeline'].to_numpy(), sorted_summary['duration_hours'].to_numpy())
+    )
     with open(filename, 'w') as f:
-        f.write(f"Week {metrics['week_number']} Summary for Year {metrics['year']}\n")
-        f.write("=" * 40 + "\n")
-        f.write(f"Total Time Tracked: {metrics['total_tracked_hours']:.2f} hours out of 168 hours possible\n")
-        f.write(f"Tracking Coverage: {metrics['tracking_percentage']:.2f}%\n\n")
-        
-        f.write("Sleep Tracking Metrics:\n")
-        f.write(f"  On-Bed Time Variance: {metrics['on_bed_time_variance']} min\n")
-        f.write(f"  Average Sleep Duration: {metrics['avg_sleep_duration']} h\n")
-        f.write(f"  Average Bedtime: {metrics['avg_bedtime']}\n")
-        f.write(f"  Average Wake-up Time: {metrics['avg_wake_time']}\n\n")
-        
-        f.write("Activity Summary (in hours):\n")
-        # Sort the summary by duration_hours in descending order and round to one decimal
-        sorted_summary = summary.sort_values(by='duration_hours', ascending=False)
-        for _, row in sorted_summary.iterrows():
-            activity = row['timeline']
-            hours = row['duration_hours']
-            f.write(f"  {activity.capitalize()}: {hours:.1f} hours\n")
+        f.write(''.join(parts))
     print(f"Weekly summary TXT file created: {filename}")
 
 
 if __name__ == "__main__":
     file_path = 'feedback/export_week8_2025_detailed.csv'
-    processed_data, summary_data, metrics = process_time_tracking(file_path)
+    processed_data, summary_data, metrics = process_time_tracking(file_path, verbose=True)
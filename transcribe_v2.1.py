@@ -1,23 +1,69 @@
+import io
 import os
+import atexit
+import json
 import subprocess
 import re
 import wave
 import pyaudio
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from datetime import datetime
 from openai import OpenAI
 from dotenv import load_dotenv
+from whisper_common import (
+    USE_LOCAL_WHISPER, LOCAL_WHISPER_MODEL, LOCAL_BATCH_SIZE, API_MODEL,
+    get_local_whisper, audio_file_cache_key, load_cached_transcript, save_cached_transcript,
+)
 
 
 SUBJECT_KEYWORDS = ["ai", 
                     "biology",
                     "reading note"]
 
+# Number of GPT requests in flight at once, and paragraphs cleaned per request
+GPT_MAX_WORKERS = 8
+GPT_BATCH_SIZE = 10
+GPT_MAX_RETRIES = 5
+
+# Output cap many chat models enforce; a batch of 3-sentence paragraphs fits well inside it
+GPT_MAX_OUTPUT_TOKENS = 4096
+
+# Line separating paragraphs inside a batched GPT request
+PARAGRAPH_SENTINEL = "###PARA###"
+
+# Regexes used on every line of text, compiled once at import
+_SENT = re.compile(r'\s*([^.?!]*[.?!]*)')
+# Runs of filler words and whitespace; group 1 is set when the run holds whitespace
+_CLEAN = re.compile(r"(?:(\s)|\b(?:um|uh|like|you know|i mean)\b)+", re.IGNORECASE)
+# Disfluencies _CLEAN leaves for GPT: repeated words and hedging phrases
+_FILLER = re.compile(r"\b(\w+)\s+\1\b|\b(?:basically|kind of|sort of|i guess|you see|erm?|hmm+|ah)\b",
+                     re.IGNORECASE)
+# Openers GPT sometimes adds around its answer, matched at line start as one alternation
+META_PATTERNS = [
+    r"Certainly",
+    r"Sure",
+    r"As an AI",
+    r"I'm an AI",
+    r"Here.*text",
+    r"Of course",
+]
+_META = re.compile("|".join(f"(?:{pattern})" for pattern in META_PATTERNS), re.IGNORECASE)
+_WORD_BYTES = re.compile(rb"\S+")
+
+# Output directory for transcriptions, resolved and created once at import
+_BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcriptions")
+os.makedirs(_BASE_DIR, exist_ok=True)
+
 
 load_dotenv()
+# The client retries rate-limited and failed requests itself, honoring Retry-After
 client = OpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=GPT_MAX_RETRIES,
 )
 
 
@@ -25,37 +71,57 @@ client = OpenAI(
 
 def whisper_transcribe(audio_file_path):
     """
-    Transcribe the audio file using OpenAI's Whisper API.
-    If the file exceeds 25MB, compress it using ffmpeg before transcribing.
+    Transcribe the audio file using OpenAI's Whisper API, or the local
+    faster-whisper model when USE_LOCAL_WHISPER is set.
+    If the file exceeds 25MB, compress it using ffmpeg before sending it to the API.
+    Results are cached by audio content, so the same file is only transcribed once.
     """
     MAX_FILE_SIZE = 25 * 1024 * 1024  # 25MB
     
     try:
+        model_name = f"faster-whisper-{LOCAL_WHISPER_MODEL}" if USE_LOCAL_WHISPER else API_MODEL
+        key = audio_file_cache_key(model_name, audio_file_path)
+        cached = load_cached_transcript(key)
+        if cached is not None:
+            print("Using cached transcription.")
+            return cached
+        
+        if USE_LOCAL_WHISPER:
+            # No upload limit locally; the pipeline decodes and batches the file itself
+            segments, _ = get_local_whisper().transcribe(audio_file_path, batch_size=LOCAL_BATCH_SIZE)
+            text = " ".join(segment.text.strip() for segment in segments)
+            save_cached_transcript(key, text, model_name)
+            return text
+        
         file_size = os.path.getsize(audio_file_path)
         if file_size > MAX_FILE_SIZE:
             print(f"Warning: File size ({file_size/1024/1024:.1f}MB) exceeds OpenAI's 25MB limit.")
             print("Compressing audio file...")
             
-            # Create a temporary filename for the compressed file
-            temp_filename = audio_file_path.replace(".wav", "_compressed.wav")
+            # Pipe ffmpeg's output straight into memory instead of a temporary file
+            command = ["ffmpeg", "-loglevel", "error", "-i", audio_file_path,
+                       "-ar", "16000", "-ac", "1", "-b:a", "48k", "-f", "wav", "pipe:1"]
+            try:
+                result = subprocess.run(command, capture_output=True, check=True)
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(f"ffmpeg failed: {e.stderr.decode(errors='replace').strip()}") from e
             
-            # Use ffmpeg to compress the file
-            command = f'ffmpeg -i "{audio_file_path}" -ar 16000 -ac 1 -b:a 48k "{temp_filename}"'
-            subprocess.run(command, shell=True, check=True)
+            # Check the size of what is actually uploaded, not the original file
+            if len(result.stdout) > MAX_FILE_SIZE:
+                print(f"Warning: Compressed audio ({len(result.stdout)/1024/1024:.1f}MB) still exceeds the 25MB limit.")
             
-            # Use the compressed file for transcription
-            audio_file_path = temp_filename
-
-        with open(audio_file_path, "rb") as audio_file:
             transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
+                model=API_MODEL,
+                file=("audio.wav", io.BytesIO(result.stdout))
             )
+        else:
+            with open(audio_file_path, "rb") as audio_file:
+                transcript = client.audio.transcriptions.create(
+                    model=API_MODEL,
+                    file=audio_file
+                )
         
-        # Clean up temporary file if it exists
-        if audio_file_path.endswith("_compressed.wav"):
-            os.remove(audio_file_path)
-        
+        save_cached_transcript(key, transcript.text, API_MODEL)
         return transcript.text
 
     except Exception as e:
@@ -65,61 +131,46 @@ def whisper_transcribe(audio_file_path):
 
 # Text Processing Functions
 
-def split_into_sentences(text):
+def iter_sentences(text):
+    """
+    Lazily split text into sentences on .?! (keeping the punctuation),
+    skipping empty matches.
     """
-    Improved sentence splitter using regex that separates on .?! but 
-    keeps punctuation with the preceding token.
+    for match in _SENT.finditer(text):
+        sentence = match.group(1).strip()
+        if sentence:
+            yield sentence
+
+def _chunks(iterable, n):
     """
-    text = text.strip()
-    parts = re.split(r'([.?!])', text)
-    sentences = []
-    for i in range(0, len(parts), 2):
-        chunk = parts[i].strip()
-        if i + 1 < len(parts):
-            punctuation = parts[i + 1]
-            chunk += punctuation
-        if chunk:
-            sentences.append(chunk.strip())
-    return sentences
-
-def group_sentences_into_paragraphs(sentences, paragraph_size=3):
+    Yield the items of an iterable joined with spaces, n at a time.
     """
-    Group sentences into paragraphs based on a fixed number of sentences.
+    it = iter(iterable)
+    while True:
+        group = list(islice(it, n))
+        if not group:
+            return
+        yield " ".join(group)
+
+def iter_paragraphs(text, paragraph_size=3):
     """
-    paragraphs = []
-    for i in range(0, len(sentences), paragraph_size):
-        group = sentences[i : i + paragraph_size]
-        paragraph_text = " ".join(group)
-        paragraphs.append(paragraph_text)
-    return paragraphs
+    Yield paragraphs of a fixed number of sentences, in a single pass.
+    """
+    return _chunks(iter_sentences(text), paragraph_size)
 
 def remove_meta_talk(text):
     """
     Removes common lines that might appear in GPT responses, such as
     'Certainly!', 'Sure!', or 'As an AI language model...'
     """
-    meta_patterns = [
-        r"^Certainly.*",
-        r"^Sure.*",
-        r"^As an AI.*",
-        r"^I'm an AI.*",
-        r"^Here.*text.*",
-        r"^Of course.*"
-    ]
-    
-    lines = text.split("\n")
-    cleaned_lines = []
-    
-    for line in lines:
-        if any(re.match(pattern, line.strip(), re.IGNORECASE) for pattern in meta_patterns):
-            continue
-        cleaned_lines.append(line)
-    
-    return "\n".join(cleaned_lines)
+    return "\n".join(line for line in text.split("\n") if not _META.match(line.lstrip()))
 
-def process_with_gpt(text, client):
+def process_with_gpt(text, client, keep_sentinel=False, max_tokens=1500):
     """
     Process text through GPT to improve clarity while maintaining core meaning.
+    With keep_sentinel, GPT is told to leave PARAGRAPH_SENTINEL lines untouched
+    and a (text, finish_reason) pair is returned, so a reply cut short by
+    max_tokens can be detected; finish_reason is None if the request failed.
     """
     system_prompt = (
         "You are a minimal text editor. Your task is to:\n"
@@ -133,6 +184,12 @@ def process_with_gpt(text, client):
         "Important: Make minimal changes. If a sentence is understandable, leave it as is.\n"
         "Never paraphrase or rewrite unless absolutely necessary for clarity."
     )
+    if keep_sentinel:
+        system_prompt += (
+            f"\n\nThe text contains several paragraphs separated by lines reading exactly "
+            f"'{PARAGRAPH_SENTINEL}'. Edit each paragraph separately and keep every "
+            f"'{PARAGRAPH_SENTINEL}' line exactly as it is, in the same place."
+        )
 
     user_prompt = (
         f"Please make minimal improvements to this transcribed speech, "
@@ -147,24 +204,61 @@ def process_with_gpt(text, client):
                 {"role": "user", "content": user_prompt}
             ],
             temperature=0.2,
-            max_tokens=1500
+            max_tokens=max_tokens
         )
-        gpt_output = response.choices[0].message.content.strip()
+        choice = response.choices[0]
+        gpt_output = choice.message.content.strip()
         cleaned_output = remove_meta_talk(gpt_output)
-        return cleaned_output
+        return (cleaned_output, choice.finish_reason) if keep_sentinel else cleaned_output
     except Exception as e:
         print(f"Error processing text with GPT: {str(e)}")
-        return text  # Return original text if processing fails
+        # Return original text if processing fails
+        return (text, None) if keep_sentinel else text
+
+def process_batch_with_gpt(blocks, client):
+    """
+    Clean several paragraphs with a single GPT request by joining them with
+    PARAGRAPH_SENTINEL and splitting the reply. If the reply was cut short or does
+    not split back into the same number of paragraphs, each paragraph is sent on its own.
+    """
+    if len(blocks) == 1:
+        return [process_with_gpt(blocks[0], client)]
+
+    joined = f"\n\n{PARAGRAPH_SENTINEL}\n\n".join(blocks)
+    gpt_output, finish_reason = process_with_gpt(joined, client, keep_sentinel=True,
+                                                 max_tokens=min(1500 * len(blocks), GPT_MAX_OUTPUT_TOKENS))
+    # A reply stopped by max_tokens can keep every sentinel yet end mid-paragraph
+    if finish_reason == "length":
+        print("GPT batch reply was cut short; cleaning paragraphs individually.")
+        return [process_with_gpt(block, client) for block in blocks]
+    cleaned = [part.strip() for part in gpt_output.split(PARAGRAPH_SENTINEL)]
+    if len(cleaned) != len(blocks):
+        print("GPT batch lost paragraph boundaries; cleaning paragraphs individually.")
+        return [process_with_gpt(block, client) for block in blocks]
+    return cleaned
+
+def _collapse_filler_run(match):
+    return " " if match.group(1) is not None else ""
+
+def _looks_clean(block):
+    """
+    Cheap check for paragraphs GPT would leave as they are: very short ones, or
+    a capitalized, punctuated paragraph with no disfluencies left after local cleaning.
+    """
+    if len(block) < 50:
+        return True
+    return (not _FILLER.search(block) and block[0].isupper()
+            and block.rstrip()[-1] in ".?!" and block.count(" ") > 3)
 
 def basic_cleaning(final_paragraph_blocks, client=None):
     """
     Basic cleaning with optional GPT processing:
     1. Remove filler words (um, uh, etc.)
     2. Capitalize first character of each sentence
-    3. If client is provided, optionally process through GPT
+    3. If client is provided, process the paragraphs that do not already look
+       clean through GPT in batches, with the batches running concurrently
     """
-    filler_pattern = re.compile(r"\b(um|uh|like|you know|i mean)\b", re.IGNORECASE)
-    cleaned_paragraphs = []
+    local_cleaned = []
 
     for block in final_paragraph_blocks:
         lines = block.split("\n")
@@ -174,8 +268,8 @@ def basic_cleaning(final_paragraph_blocks, client=None):
             if not line:
                 continue
 
-            line = filler_pattern.sub("", line)
-            line = re.sub(r"\s+", " ", line).strip()
+            # Drop filler words and collapse whitespace in one pass
+            line = _CLEAN.sub(_collapse_filler_run, line).strip()
 
             if line.startswith("* "):
                 bullet_content = line[2:].strip()
@@ -187,18 +281,44 @@ def basic_cleaning(final_paragraph_blocks, client=None):
                     line = line[0].upper() + line[1:]
                 cleaned_lines.append(line)
         
-        cleaned_block = "\n".join(cleaned_lines)
-        
-        if client and cleaned_block:
-            cleaned_block = process_with_gpt(cleaned_block, client)
-            
-        cleaned_paragraphs.append(cleaned_block)
+        local_cleaned.append("\n".join(cleaned_lines))
+    
+    if not client:
+        return local_cleaned
+    
+    # Batch the paragraphs that still need editing so the system prompt and
+    # round-trip are paid once per batch; clean ones are kept as they are
+    indices = [i for i, block in enumerate(local_cleaned) if block and not _looks_clean(block)]
+    batches = [indices[i:i + GPT_BATCH_SIZE] for i in range(0, len(indices), GPT_BATCH_SIZE)]
+    
+    def gpt_clean(batch):
+        return process_batch_with_gpt([local_cleaned[i] for i in batch], client)
+    
+    # Batches are independent and network-bound; map() keeps them in order
+    cleaned_paragraphs = list(local_cleaned)
+    with ThreadPoolExecutor(max_workers=GPT_MAX_WORKERS) as executor:
+        for batch, cleaned in zip(batches, executor.map(gpt_clean, batches)):
+            for i, block in zip(batch, cleaned):
+                cleaned_paragraphs[i] = block
     
     return cleaned_paragraphs
 
 
 # Audio Recording Function
 
+_pyaudio = None
+
+def get_pyaudio():
+    """
+    Initialize PortAudio once and reuse it for every recording; it is
+    terminated when the interpreter exits.
+    """
+    global _pyaudio
+    if _pyaudio is None:
+        _pyaudio = pyaudio.PyAudio()
+        atexit.register(_pyaudio.terminate)
+    return _pyaudio
+
 def record_audio(output_filename="recorded_audio.wav"):
     """
     Record audio from the microphone until Enter is pressed.
@@ -208,41 +328,43 @@ def record_audio(output_filename="recorded_audio.wav"):
     sample_rate = 44100
     chunk_size = 1024
 
-    audio = pyaudio.PyAudio()
+    audio = get_pyaudio()
     stream = audio.open(format=audio_format, 
                         channels=channels,
                         rate=sample_rate,
                         input=True,
                         frames_per_buffer=chunk_size)
 
+    # Stream frames straight into the WAV file so memory stays constant
+    wf = wave.open(output_filename, "wb")
+    wf.setnchannels(channels)
+    wf.setsampwidth(audio.get_sample_size(audio_format))
+    wf.setframerate(sample_rate)
+
     print("Recording... Press Enter to stop.")
-    frames = []
+
+    # Wait for Enter on a background thread so the read loop never polls the keyboard
+    stop_event = threading.Event()
+
+    def wait_for_enter():
+        sys.stdin.readline()
+        stop_event.set()
+
+    threading.Thread(target=wait_for_enter, daemon=True).start()
 
     try:
-        while True:
-            data = stream.read(chunk_size)
-            frames.append(data)
-            if os.name == 'nt':  # Windows
-                import msvcrt
-                if msvcrt.kbhit() and msvcrt.getch() == b'\r':
-                    break
-            else:  # Mac/Linux
-                import select
-                if select.select([sys.stdin], [], [], 0.0)[0]:
-                    break
+        while not stop_event.is_set():
+            data = stream.read(chunk_size, exception_on_overflow=False)
+            # writeframesraw skips the per-call header rewrite; close() fixes it up once
+            wf.writeframesraw(data)
     except KeyboardInterrupt:
         pass
+    finally:
+        wf.close()
+        stream.stop_stream()
+        stream.close()
 
     print("Recording stopped.")
-    stream.stop_stream()
-    stream.close()
-    audio.terminate()
-
-    with wave.open(output_filename, "wb") as wf:
-        wf.setnchannels(channels)
-        wf.setsampwidth(audio.get_sample_size(audio_format))
-        wf.setframerate(sample_rate)
-        wf.writeframes(b"".join(frames))
 
     return output_filename
 
@@ -266,64 +388,60 @@ def determine_subject(raw_text, keywords):
 
 # File Appending Functions
 
-def append_to_weekly_file(text):
+def append_to_weekly_file(text, current_date=None):
     """
     Append the transcription to a weekly file.
     File name format: w{week}_{Month}_{Year}.txt
     The latest transcription is at the top with a date header.
     """
-    current_date = datetime.now()
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    base_dir = os.path.join(script_dir, "transcriptions")
-    os.makedirs(base_dir, exist_ok=True)
+    if current_date is None:
+        current_date = datetime.now()
     
     iso_calendar = current_date.isocalendar()
     week_number = iso_calendar[1]
     year = iso_calendar[0]
     month_str = current_date.strftime("%B")
     week_file = f"w{week_number}_{month_str}_{year}.txt"
-    file_path = os.path.join(base_dir, week_file)
+    file_path = os.path.join(_BASE_DIR, week_file)
 
     current_date_str = current_date.strftime("%A, %B %d, %Y")
     header_line = f"[{current_date_str}]"
 
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-            if len(lines) > 2:
-                existing_lines = lines[2:]
-            else:
-                existing_lines = []
+        with open(file_path, "rb") as f:
+            buf = f.read()
     except FileNotFoundError:
-        existing_lines = []
+        buf = b""
 
-    filtered_lines = [line for line in existing_lines if line.strip() != header_line]
-    existing_content = "".join(filtered_lines)
+    # Skip the "Total words" line and the blank line after it
+    parts = buf.split(b"\n", 2)
+    existing_content = parts[2] if len(parts) == 3 else b""
 
-    new_block = f"{header_line}\n{text}\n\n"
-    final_text = new_block + existing_content
+    # Drop today's earlier header so it only appears once, on the newest block
+    header_pattern = re.compile(rb"^[ \t]*" + re.escape(header_line.encode("utf-8")) + rb"[ \t\r]*(?:\n|\Z)", re.MULTILINE)
+    existing_content = header_pattern.sub(b"", existing_content)
 
-    total_words = len(final_text.split())
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(f"Total words: {total_words}\n\n{final_text}")
+    new_block = f"{header_line}\n{text}\n\n".encode("utf-8")
+    final_bytes = new_block + existing_content
+
+    total_words = sum(1 for _ in _WORD_BYTES.finditer(final_bytes))
+    with open(file_path, "wb") as f:
+        f.write(f"Total words: {total_words}\n\n".encode("utf-8") + final_bytes)
 
     return file_path
 
-def append_to_subject_file(text, subject):
+def append_to_subject_file(text, subject, current_date=None):
     """
     Append the transcription to a subject-specific file.
     File name format: {subject}.txt
     The latest transcription block includes a month header with a counter for transcriptions.
     If a transcription for the current month already exists, its header is removed and replaced.
     """
-    current_date = datetime.now()
+    if current_date is None:
+        current_date = datetime.now()
     current_month = current_date.strftime("%B")
     
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    base_dir = os.path.join(script_dir, "transcriptions")
-    os.makedirs(base_dir, exist_ok=True)
-    
-    subject_file = os.path.join(base_dir, f"{subject.lower()}.txt")
+    subject_file = os.path.join(_BASE_DIR, f"{subject.lower()}.txt")
     
     if os.path.exists(subject_file):
         with open(subject_file, "r", encoding="utf-8") as f:
@@ -331,15 +449,15 @@ def append_to_subject_file(text, subject):
     else:
         content = ""
     
-    lines = content.splitlines()
+    # Only the first line can be a header, so split it off instead of splitting every line
+    first_line, _, rest = content.partition("\n")
     count = 0
-    if lines and re.match(r'^\[Month: (\w+) \| Count: (\d+)\]$', lines[0]):
-        m = re.match(r'^\[Month: (\w+) \| Count: (\d+)\]$', lines[0])
-        header_month = m.group(1)
-        header_count = int(m.group(2))
-        if header_month.lower() == current_month.lower():
-            count = header_count
-            content = "\n".join(lines[1:]).lstrip()
+    # Header format is fixed: "[Month: {month} | Count: {count}]"
+    if first_line.startswith("[Month: ") and first_line.endswith("]"):
+        header_month, sep, header_count = first_line[len("[Month: "):-1].partition(" | Count: ")
+        if sep and header_count.isdecimal() and header_month.lower() == current_month.lower():
+            count = int(header_count)
+            content = rest.lstrip()
     
     count += 1
     new_header = f"[Month: {current_month} | Count: {count}]"
@@ -366,20 +484,19 @@ def main():
     subject = determine_subject(raw_transcribed_text, SUBJECT_KEYWORDS)
 
     # Part 3: Formatting the Transcribed Text
-    sentences = split_into_sentences(raw_transcribed_text)
-    paragraphs = group_sentences_into_paragraphs(sentences, paragraph_size=3)
-    uncleaned_output = "\n\n".join(paragraphs)
+    paragraphs = list(iter_paragraphs(raw_transcribed_text, paragraph_size=3))
     
     # Part 4: Cleaning with GPT processing
     cleaned_paragraphs = basic_cleaning(paragraphs, client)
     final_output = "\n\n".join(cleaned_paragraphs)
     
     # Part 5: Append to the appropriate file based on subject criteria
+    current_date = datetime.now()
     if subject:
-        output_file = append_to_subject_file(final_output, subject)
+        output_file = append_to_subject_file(final_output, subject, current_date)
         print(f"\nTranscription appended to subject-specific file: {output_file}")
     else:
-        output_file = append_to_weekly_file(final_output)
+        output_file = append_to_weekly_file(final_output, current_date)
         print(f"\nTranscription appended to weekly file: {output_file}")
     
     print("\nCleaned transcription (post-clean):")
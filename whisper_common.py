@@ -0,0 +1,78 @@
+import os
+import json
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+# Settings come from the environment or a .env file, like the API key
+load_dotenv()
+
+# Set USE_LOCAL_WHISPER=1 to transcribe with faster-whisper instead of the OpenAI API
+USE_LOCAL_WHISPER = os.getenv("USE_LOCAL_WHISPER") == "1"
+LOCAL_WHISPER_MODEL = os.getenv("LOCAL_WHISPER_MODEL", "large-v3")
+LOCAL_BATCH_SIZE = 16
+_local_pipeline = None
+
+def get_local_whisper():
+    """
+    Load the faster-whisper batched pipeline once, on first use.
+    """
+    global _local_pipeline
+    if _local_pipeline is None:
+        from faster_whisper import WhisperModel, BatchedInferencePipeline
+        model = WhisperModel(LOCAL_WHISPER_MODEL, device="cuda", compute_type="float16")
+        _local_pipeline = BatchedInferencePipeline(model=model)
+    return _local_pipeline
+
+# Transcripts are cached by a hash of the audio so re-runs skip transcription
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "transcribe")
+API_MODEL = "whisper-1"
+
+def audio_cache_key(model, audio):
+    """
+    Hash audio bytes together with the model that transcribes them.
+    """
+    digest = hashlib.sha256(model.encode("utf-8") + b"\0")
+    digest.update(audio)
+    return digest.hexdigest()
+
+def audio_file_cache_key(model, audio_file_path):
+    """
+    Hash an audio file's bytes together with the model that transcribes it,
+    reading the file in blocks.
+    """
+    digest = hashlib.sha256(model.encode("utf-8") + b"\0")
+    with open(audio_file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_cached_transcript(key):
+    """
+    Return the cached transcript for key, or None on a miss.
+    """
+    try:
+        with open(os.path.join(CACHE_DIR, f"{key}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["text"]
+    except (OSError, json.JSONDecodeError, KeyError):
+        return None
+
+def save_cached_transcript(key, text, model):
+    """
+    Store a transcript in the cache, replacing any partial write atomically.
+    """
+    cache_path = os.path.join(CACHE_DIR, f"{key}.json")
+    # Unique per process and thread, since chunks are transcribed concurrently
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # The cache is best-effort: a failed write must not lose the transcript
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"text": text, "model": model}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: could not cache transcript: {str(e)}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
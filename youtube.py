@@ -1,128 +1,278 @@
 import yt_dlp
+import io
 import os
+import sys
+import wave
+import asyncio
+import numpy as np
 from openai import OpenAI
 from dotenv import load_dotenv
-from pydub import AudioSegment
-from pydub.silence import detect_nonsilent
+from whisper_common import (
+    USE_LOCAL_WHISPER, LOCAL_WHISPER_MODEL, LOCAL_BATCH_SIZE, API_MODEL,
+    get_local_whisper, audio_cache_key, load_cached_transcript, save_cached_transcript,
+)
+
+# Whisper requests allowed in flight at once, and retries when rate limited
+MAX_CONCURRENT_TRANSCRIPTIONS = 5
+MAX_RETRIES = 5
 
 load_dotenv()
+# The client retries rate-limited and failed requests itself, honoring Retry-After
 client = OpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=MAX_RETRIES,
 )
 
-def split_on_silence(audio_path, min_silence_len=1000, silence_thresh=-40, chunk_length_ms=180000):
+# Audio is decoded once to 16kHz mono int16, the format Whisper works in
+SAMPLE_RATE = 16000
+SAMPLES_PER_MS = SAMPLE_RATE // 1000
+
+# Characters that are invalid in file names on Windows or other common filesystems
+_UNSAFE_FILENAME_CHARS = str.maketrans({c: "_" for c in '<>:"/\\|?*' + "".join(map(chr, range(32)))})
+# File names are limited to 255 bytes on ext4/APFS; leave room for the suffix
+MAX_TITLE_BYTES = 200
+
+def detect_nonsilent(pcm, min_silence_len=1000, silence_thresh=-16):
     """
-    Split audio file into chunks at silence points
-    chunk_length_ms = 3 minutes (180000ms)
-    min_silence_len = 1 second (1000ms)
+    NumPy port of pydub.silence.detect_nonsilent for 16kHz mono int16 samples.
+    Returns [start_ms, end_ms] ranges that are not part of a silence of at
+    least min_silence_len ms quieter than silence_thresh dBFS.
     """
-    audio = AudioSegment.from_wav(audio_path)
+    total_ms = len(pcm) // SAMPLES_PER_MS
+    if total_ms < min_silence_len:
+        return [[0, total_ms]] if total_ms else []
     
-    # Initialize chunks
-    chunks = []
-    start_time = 0
+    # Sum of squares per millisecond, then per window of min_silence_len via a running sum;
+    # int64 keeps the running sum exact even for hours of loud audio
+    per_ms = pcm[:total_ms * SAMPLES_PER_MS].reshape(total_ms, SAMPLES_PER_MS).astype(np.int64)
+    energy = np.concatenate(([0], np.cumsum((per_ms * per_ms).sum(axis=1))))
+    window_energy = energy[min_silence_len:] - energy[:-min_silence_len]
+    # Truncated to an int like audioop.rms, so results match pydub exactly
+    window_rms = np.floor(np.sqrt(window_energy / (min_silence_len * SAMPLES_PER_MS)))
     
-    while start_time < len(audio):
-        # Get a chunk of desired length
-        end_time = min(start_time + chunk_length_ms, len(audio))
-        chunk = audio[start_time:end_time]
-        
-        if end_time < len(audio):
-            # Find the nearest silence point after chunk_length
-            silence_points = detect_nonsilent(chunk, min_silence_len, silence_thresh)
-            if silence_points:
-                # Adjust end_time to the last non-silent segment
-                end_time = start_time + silence_points[-1][1]
-        
-        chunks.append(audio[start_time:end_time])
-        start_time = end_time
+    # Same threshold as pydub: dBFS relative to the int16 full scale
+    rms_thresh = 10 ** (silence_thresh / 20) * 32768
+    silent = window_rms <= rms_thresh
     
-    return chunks
-
-def download_youtube_audio(url, output_path="downloads"):
-    """Download audio from YouTube video"""
-    # Create output directory if it doesn't exist
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
+    # Runs of silent window starts become silent ranges; find their edges with np.diff
+    edges = np.diff(np.concatenate(([0], silent.view(np.int8), [0])))
+    silent_starts = np.flatnonzero(edges == 1)
+    silent_ends = np.flatnonzero(edges == -1) - 1 + min_silence_len
     
-    # Sanitize output filename
+    # Everything between the silent ranges is non-silent
+    nonsilent_starts = np.concatenate(([0], silent_ends))
+    nonsilent_ends = np.concatenate((silent_starts, [total_ms]))
+    keep = nonsilent_ends > nonsilent_starts
+    return np.column_stack((nonsilent_starts[keep], nonsilent_ends[keep])).tolist()
+
+def next_chunk_end(pcm, min_silence_len=1000, silence_thresh=-40, chunk_length_ms=180000):
+    """
+    Return where the chunk starting at pcm[0] should end, in ms: after the last
+    speech that ends within chunk_length_ms, or a hard cut if none does.
+    Only needs chunk_length_ms + min_silence_len of audio to decide.
+    """
+    window = pcm[:(chunk_length_ms + min_silence_len) * SAMPLES_PER_MS]
+    speech_ends = [end for _, end in detect_nonsilent(window, min_silence_len, silence_thresh)
+                   if 0 < end <= chunk_length_ms]
+    return speech_ends[-1] if speech_ends else chunk_length_ms
+
+def resolve_audio_format(url):
+    """Look up a YouTube video's title and best audio format without downloading it"""
     ydl_opts = {
         'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'wav',
-        }],
-        # Use video ID instead of title for the filename
-        'outtmpl': os.path.join(output_path, '%(id)s.%(ext)s'),
+        'quiet': True,
     }
     
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            # Use video ID for the audio file name
-            audio_file = os.path.join(output_path, f"{info['id']}.wav")
-            return audio_file, info['title']
+            info = ydl.extract_info(url, download=False)
+            return info['webpage_url'], info['format_id'], info['title']
     except Exception as e:
-        print(f"Error downloading YouTube video: {str(e)}")
-        return None, None
+        print(f"Error resolving YouTube audio stream: {str(e)}")
+        return None, None, None
+
+def download_command(video_url, format_id):
+    """yt-dlp command that writes the chosen audio format to stdout as it downloads"""
+    # yt-dlp fetches YouTube formats in ranged chunks; a single unranged GET gets throttled
+    return [sys.executable, "-m", "yt_dlp", "--quiet", "--no-progress",
+            "-f", format_id, "-o", "-", video_url]
 
-def transcribe_chunk(chunk, chunk_path):
-    """Transcribe a single audio chunk"""
+async def produce_chunks(video_url, format_id, queue, num_consumers,
+                         min_silence_len=1000, silence_thresh=-40, chunk_length_ms=180000):
+    """
+    Decode the audio to 16kHz mono int16 as yt-dlp downloads it and queue (index, samples)
+    chunks cut at silence as soon as each one is settled, then one None per consumer
+    chunk_length_ms = 3 minutes (180000ms)
+    min_silence_len = 1 second (1000ms)
+    """
+    command = ["ffmpeg", "-loglevel", "error", "-i", "pipe:0",
+               "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"]
+    ready_bytes = (chunk_length_ms + min_silence_len) * SAMPLES_PER_MS * 2
+    chunk_bytes = chunk_length_ms * SAMPLES_PER_MS * 2
+    download = proc = None
+    
     try:
-        # Export chunk to temporary file
-        chunk.export(chunk_path, format="wav")
+        # yt-dlp writes into a pipe that ffmpeg reads as its input
+        read_fd, write_fd = os.pipe()
+        try:
+            download = await asyncio.create_subprocess_exec(*download_command(video_url, format_id),
+                                                            stdout=write_fd)
+            proc = await asyncio.create_subprocess_exec(*command, stdin=read_fd,
+                                                        stdout=asyncio.subprocess.PIPE)
+        finally:
+            # The children hold their own copies; ffmpeg only sees EOF once ours is closed too
+            os.close(read_fd)
+            os.close(write_fd)
+        pending = bytearray()
+        index = 0
+        eof = False
+        while not eof:
+            block = await proc.stdout.read(1 << 20)
+            eof = not block
+            pending += block
+            
+            # A cut is settled once a full chunk plus one silence length is buffered;
+            # at the end of the stream whatever is left is all there will be
+            while len(pending) >= ready_bytes or (eof and len(pending) > chunk_bytes):
+                pcm = np.frombuffer(pending, dtype=np.int16, count=len(pending) // 2)
+                end_ms = next_chunk_end(pcm, min_silence_len, silence_thresh, chunk_length_ms)
+                index += 1
+                await queue.put((index, pcm[:end_ms * SAMPLES_PER_MS].copy()))
+                pending = pending[end_ms * SAMPLES_PER_MS * 2:]
+        
+        if len(pending) >= SAMPLES_PER_MS * 2:
+            index += 1
+            await queue.put((index, np.frombuffer(pending, dtype=np.int16, count=len(pending) // 2)))
         
-        with open(chunk_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
+        failed = await proc.wait() != 0
+        failed = await download.wait() != 0 or failed
+        if failed:
+            if index:
+                print("Warning: audio stream ended with an error; the transcription may be incomplete")
+            else:
+                print("Error: could not read the audio stream")
+        print(f"Split into {index} chunks")
+    except FileNotFoundError:
+        print("Error: ffmpeg was not found; install it and make sure it is on PATH")
+    finally:
+        for child in (download, proc):
+            if child is not None and child.returncode is None:
+                child.kill()
+                await child.wait()
+        for _ in range(num_consumers):
+            await queue.put(None)
+
+def transcribe_chunk(samples, chunk_name):
+    """Transcribe a single chunk of samples"""
+    try:
+        key = audio_cache_key(API_MODEL, samples)
+        cached = load_cached_transcript(key)
+        if cached is not None:
+            return cached
+        
+        # Encode the chunk as WAV in memory instead of a temporary file
+        wav_buffer = io.BytesIO()
+        with wave.open(wav_buffer, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(SAMPLE_RATE)
+            wf.writeframes(samples)
+        wav_bytes = wav_buffer.getvalue()
+        
+        transcript = client.audio.transcriptions.create(
+            model=API_MODEL,
+            file=(chunk_name, wav_bytes)
+        )
+        save_cached_transcript(key, transcript.text, API_MODEL)
         return transcript.text
     except Exception as e:
         print(f"Error transcribing chunk: {str(e)}")
         return None
-    finally:
-        if os.path.exists(chunk_path):
-            os.remove(chunk_path)
 
-def main():
+def transcribe_chunk_local(samples):
+    """Transcribe a single chunk of samples in memory with the local faster-whisper model"""
+    try:
+        model_name = f"faster-whisper-{LOCAL_WHISPER_MODEL}"
+        key = audio_cache_key(model_name, samples)
+        cached = load_cached_transcript(key)
+        if cached is not None:
+            return cached
+        
+        # Whisper expects 16kHz mono float32 samples in [-1, 1]
+        audio = samples.astype(np.float32) / 32768.0
+        segments, _ = get_local_whisper().transcribe(audio, batch_size=LOCAL_BATCH_SIZE)
+        text = " ".join(segment.text.strip() for segment in segments)
+        save_cached_transcript(key, text, model_name)
+        return text
+    except Exception as e:
+        print(f"Error transcribing chunk: {str(e)}")
+        return None
+
+async def consume_chunks(queue, results, transcribe):
+    """Transcribe queued chunks until a None arrives, storing each result by chunk index"""
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        index, samples = item
+        print(f"Processing chunk {index}...")
+        # Transcription is blocking, so run it on a worker thread
+        results[index] = await asyncio.to_thread(transcribe, samples, index)
+
+async def transcribe_stream(video_url, format_id, max_concurrent=MAX_CONCURRENT_TRANSCRIPTIONS):
+    """
+    Download, chunk and transcribe at the same time: chunks are transcribed while
+    the rest of the audio is still streaming in. Returns results in chunk order.
+    """
+    if USE_LOCAL_WHISPER:
+        # The local model batches on the GPU itself, so feed chunks one at a time
+        def transcribe(samples, index):
+            return transcribe_chunk_local(samples)
+        max_concurrent = 1
+    else:
+        def transcribe(samples, index):
+            return transcribe_chunk(samples, f"chunk_{index}.wav")
+    
+    # Bounded so a fast download cannot run far ahead of transcription
+    queue = asyncio.Queue(maxsize=8)
+    results = {}
+    consumers = [consume_chunks(queue, results, transcribe) for _ in range(max_concurrent)]
+    await asyncio.gather(produce_chunks(video_url, format_id, queue, max_concurrent), *consumers)
+    return [results[index] for index in sorted(results)]
+
+async def main():
     # YouTube video URL
     video_url = input("Enter YouTube video URL: ")
     
-    # Download audio
-    print("Downloading audio...")
-    audio_file, video_title = download_youtube_audio(video_url)
+    # Look up the audio stream; it is downloaded while being transcribed
+    page_url, format_id, video_title = resolve_audio_format(video_url)
     
-    if audio_file:
-        print("Audio downloaded successfully!")
-        print("Splitting audio into chunks...")
+    if page_url:
+        print("Streaming, splitting and transcribing audio...")
+        results = await transcribe_stream(page_url, format_id)
+        all_transcriptions = [t for t in results if t]
         
-        chunks = split_on_silence(audio_file)
-        print(f"Split into {len(chunks)} chunks")
-        
-        # Process each chunk
-        all_transcriptions = []
-        for i, chunk in enumerate(chunks, 1):
-            print(f"\nProcessing chunk {i}/{len(chunks)}...")
-            chunk_path = f"downloads/temp_chunk_{i}.wav"
-            
-            transcription = transcribe_chunk(chunk, chunk_path)
-            if transcription:
-                all_transcriptions.append(transcription)
+        # Nothing was transcribed, e.g. the stream could not be downloaded
+        if not all_transcriptions:
+            print("Transcription failed: no audio chunk produced any text")
+            return
         
         # Combine all transcriptions
         final_transcription = " ".join(all_transcriptions)
         
         # Save complete transcription
-        output_file = os.path.join("downloads", f"{video_title}_transcription.txt")
+        os.makedirs("downloads", exist_ok=True)
+        # Titles can contain path separators and other characters a file name cannot
+        safe_title = video_title.translate(_UNSAFE_FILENAME_CHARS)
+        # Truncate on the UTF-8 length, dropping any character cut in half; Windows
+        # also rejects names ending in a dot or space
+        safe_title = safe_title.encode("utf-8")[:MAX_TITLE_BYTES].decode("utf-8", errors="ignore")
+        safe_title = safe_title.rstrip(". ") or "video"
+        output_file = os.path.join("downloads", f"{safe_title}_transcription.txt")
         with open(output_file, 'w', encoding='utf-8') as f:
             f.write(final_transcription)
         
         print(f"\nComplete transcription saved to: {output_file}")
-        
-        # Clean up original audio file
-        os.remove(audio_file)
-        print("Audio file cleaned up")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())